@@ -3,6 +3,31 @@ Playlist generation algorithm for Marathon Music.
 Selects and orders songs based on race pacing and energy requirements.
 """
 
+import bisect
+import logging
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Cadence lookup table: pace bucket boundaries (min/km) and the cadence
+# for each bucket. Faster pace = higher cadence (rough approximation):
+# elite runners ~3:00/km pace -> 180 spm, recreational ~6:00/km -> 170 spm
+_PACE_BOUNDARIES = [4.0, 5.0]
+_CADENCE_VALUES = [180, 175, 170]
+
+# Static race-phase template: (name, start_pct, end_pct, energy_min, energy_max).
+# Only the phase times depend on the goal, so the structure is built once here
+# rather than on every request.
+_PHASE_TEMPLATE = (
+    ('Warmup', 0.0, 0.05, 0.5, 0.6),
+    ('Settle', 0.05, 0.30, 0.5, 0.65),
+    ('Cruise', 0.30, 0.55, 0.6, 0.7),
+    ('Grind', 0.55, 0.75, 0.7, 0.8),
+    ('Wall', 0.75, 0.90, 0.80, 1.0),
+    ('Glory', 0.90, 1.0, 0.85, 1.0),
+)
+
 
 def calculate_target_cadence(distance_km, goal_time_min):
     """
@@ -15,18 +40,22 @@ def calculate_target_cadence(distance_km, goal_time_min):
     Returns:
         Target cadence in steps per minute (typically 170-180)
     """
-    # Calculate pace in min/km
+    # Calculate pace in min/km, then branchless bucket lookup
     pace_min_per_km = goal_time_min / distance_km
+    return _CADENCE_VALUES[bisect.bisect_right(_PACE_BOUNDARIES, pace_min_per_km)]
+
+
+def calculate_target_cadence_batch(pace_arr):
+    """
+    Vectorized form of calculate_target_cadence for arrays of paces.
+
+    Args:
+        pace_arr: Array of paces in min/km
 
-    # Faster pace = higher cadence (rough approximation)
-    # Elite runners: ~3:00/km pace → 180 spm
-    # Recreational: ~6:00/km pace → 170 spm
-    if pace_min_per_km < 4.0:
-        return 180
-    elif pace_min_per_km < 5.0:
-        return 175
-    else:
-        return 170
+    Returns:
+        int array of target cadences in steps per minute
+    """
+    return np.take(_CADENCE_VALUES, np.searchsorted(_PACE_BOUNDARIES, pace_arr, side='right'))
 
 
 def define_race_phases(distance_km, goal_time_min):
@@ -40,189 +69,177 @@ def define_race_phases(distance_km, goal_time_min):
     Returns:
         List of phase dictionaries with name, start_time, end_time, energy_range
     """
-    phases = [
-        {
-            'name': 'Warmup',
-            'start_pct': 0.0,
-            'end_pct': 0.05,
-            'energy_min': 0.5,
-            'energy_max': 0.6
-        },
-        {
-            'name': 'Settle',
-            'start_pct': 0.05,
-            'end_pct': 0.30,
-            'energy_min': 0.5,
-            'energy_max': 0.65
-        },
+    # Convert the template percentages to actual times in minutes
+    return [
         {
-            'name': 'Cruise',
-            'start_pct': 0.30,
-            'end_pct': 0.55,
-            'energy_min': 0.6,
-            'energy_max': 0.7
-        },
-        {
-            'name': 'Grind',
-            'start_pct': 0.55,
-            'end_pct': 0.75,
-            'energy_min': 0.7,
-            'energy_max': 0.8
-        },
-        {
-            'name': 'Wall',
-            'start_pct': 0.75,
-            'end_pct': 0.90,
-            'energy_min': 0.80,
-            'energy_max': 1.0
-        },
-        {
-            'name': 'Glory',
-            'start_pct': 0.90,
-            'end_pct': 1.0,
-            'energy_min': 0.85,
-            'energy_max': 1.0
+            'name': name,
+            'start_pct': start_pct,
+            'end_pct': end_pct,
+            'energy_min': energy_min,
+            'energy_max': energy_max,
+            'start_time': start_pct * goal_time_min,
+            'end_time': end_pct * goal_time_min,
+            'duration': (end_pct - start_pct) * goal_time_min
         }
+        for name, start_pct, end_pct, energy_min, energy_max in _PHASE_TEMPLATE
     ]
 
-    # Convert percentages to actual times in minutes
-    for phase in phases:
-        phase['start_time'] = phase['start_pct'] * goal_time_min
-        phase['end_time'] = phase['end_pct'] * goal_time_min
-        phase['duration'] = phase['end_time'] - phase['start_time']
-
-    return phases
 
+def quantize_tempo(tempo_arr):
+    """
+    Quantize tempos to int16 half-BPM units.
 
-def filter_tracks_for_phase(tracks, phase, target_cadence, bpm_tolerance=5):
+    Half-BPM units keep the half-cadence band integral (175 spm / 2 =
+    87.5 BPM), so every comparison in bpm_match_mask stays in integer
+    arithmetic. The rounding error is far below the precision of
+    Spotify's tempo estimates.
     """
-    Filter tracks suitable for a specific race phase.
+    return np.rint(tempo_arr * 2).astype(np.int16)
 
-    Args:
-        tracks: List of track dictionaries with audio features
-        phase: Phase dictionary with energy requirements
-        target_cadence: Target BPM (or half-BPM is also acceptable)
-        bpm_tolerance: How much BPM can deviate from target
 
-    Returns:
-        List of suitable tracks for this phase
-    """
-    suitable_tracks = []
+def quantize_feature(value):
+    """Quantize a unit-interval feature value (or array) to uint8 steps of 1/255."""
+    return np.rint(np.multiply(value, 255)).astype(np.uint8)
 
-    for track in tracks:
-        tempo = track['tempo']
-        energy = track['energy']
 
-        # Check if BPM matches target cadence or half-cadence
-        # e.g., if target is 175, accept 170-180 or 85-90
-        matches_full_cadence = (target_cadence - bpm_tolerance <= tempo <= target_cadence + bpm_tolerance)
-        matches_half_cadence = (target_cadence/2 - bpm_tolerance <= tempo <= target_cadence/2 + bpm_tolerance)
-        matches_double_cadence = (target_cadence*2 - bpm_tolerance <= tempo <= target_cadence*2 + bpm_tolerance)
+def bpm_distance(tempo_q, target_cadence):
+    """
+    Compute each track's distance to the nearest cadence band.
 
-        # Check if energy level matches phase requirements
-        matches_energy = (phase['energy_min'] <= energy <= phase['energy_max'])
+    A track matches a tolerance t iff its distance to the closest of the
+    full/half/double cadence is <= t, so the three per-band range checks
+    collapse into one distance vector that every tolerance level (normal
+    and relaxed) can threshold without rescanning the tempos.
 
-        if (matches_full_cadence or matches_half_cadence or matches_double_cadence) and matches_energy:
-            suitable_tracks.append(track)
+    Args:
+        tempo_q: int16 array of track tempos in half-BPM units
+            (from quantize_tempo)
+        target_cadence: Target BPM (half/double BPM is also acceptable)
 
-    return suitable_tracks
+    Returns:
+        int16 array of distances in half-BPM units; a BPM tolerance of
+        `tol` corresponds to `bpm_distance(...) <= 2 * tol`
+        (e.g., if target is 175 and tol is 5, accept 170-180 or 85-90)
+    """
+    # Everything in half-BPM units so the arithmetic is pure int16 SIMD
+    return np.minimum.reduce([
+        np.abs(tempo_q - 2 * target_cadence),
+        np.abs(tempo_q - target_cadence),
+        np.abs(tempo_q - 4 * target_cadence)
+    ])
 
 
-def fill_phase_duration(tracks, phase_duration_min):
+def fill_phase_duration(candidate_idx, duration_arr, phase_duration_min):
     """
     Select tracks to fill the phase duration without going over too much.
 
     Args:
-        tracks: List of suitable tracks for this phase
+        candidate_idx: Array of indices of suitable tracks for this phase
+        duration_arr: int64 array of track durations (ms), aligned with
+            the library
         phase_duration_min: How long this phase should be (in minutes)
 
     Returns:
-        List of selected tracks
+        Array of selected track indices
     """
-    if not tracks:
-        return []
-
     target_duration_ms = phase_duration_min * 60 * 1000
-    selected_tracks = []
-    current_duration_ms = 0
-
-    # Sort by energy for gradual build (or use valence, danceability as tiebreakers)
-    # For simplicity, we'll just randomly sample and try to fill duration
-    available_tracks = tracks.copy()
 
-    while current_duration_ms < target_duration_ms and available_tracks:
-        # Pick the next track
-        # Simple approach: just take tracks in order
-        # More sophisticated: sort by energy, valence, etc.
-        track = available_tracks.pop(0)
-        selected_tracks.append(track)
-        current_duration_ms += track['duration_ms']
+    # Filling until the target is crossed is a prefix-sum threshold:
+    # take candidates through the first cumulative duration >= target
+    cumulative_ms = np.cumsum(duration_arr[candidate_idx])
+    cutoff = int(np.searchsorted(cumulative_ms, target_duration_ms)) + 1
 
-    return selected_tracks
+    return candidate_idx[:cutoff]
 
 
-def generate_playlist(tracks, distance_km, goal_time_min):
+def generate_playlist(distance_km, goal_time_min, tempo_arr, energy_arr, valence_arr, duration_arr):
     """
     Main algorithm: generate a race-optimized playlist.
 
+    Operates entirely on the aligned feature columns; the caller maps the
+    returned indices back to its track records.
+
     Args:
-        tracks: List of track dictionaries with audio features
         distance_km: Race distance in kilometers
         goal_time_min: Goal finish time in minutes
+        tempo_arr: float32 array of track tempos
+        energy_arr: float32 array of track energies
+        valence_arr: float32 array of track valences
+        duration_arr: int64 array of track durations (ms)
 
     Returns:
-        Ordered list of tracks for the playlist
+        Ordered array of track indices for the playlist
     """
-    print(f"\nGenerating playlist for {distance_km}km in {goal_time_min} minutes...")
+    logger.debug("Generating playlist for %skm in %s minutes...", distance_km, goal_time_min)
 
     # Step 1: Calculate target cadence
     target_cadence = calculate_target_cadence(distance_km, goal_time_min)
-    print(f"Target cadence: {target_cadence} spm")
+    logger.debug("Target cadence: %s spm", target_cadence)
 
     # Step 2: Define race phases
     phases = define_race_phases(distance_km, goal_time_min)
 
     # Step 3: Build playlist phase by phase
-    playlist = []
+    selected = []
     bpm_tolerance = 5
 
+    # Quantized feature columns: int16 half-BPM tempos and uint8 energy
+    # make the filter compares integer-only, packing more SIMD lanes per
+    # instruction than the float columns
+    tempo_q = quantize_tempo(tempo_arr)
+    energy_q = quantize_feature(energy_arr)
+    valence_q = quantize_feature(valence_arr)
+
+    # Sort the library once by energy with valence as tiebreaker; each
+    # phase's energy window then comes from a binary search instead of a
+    # full scan and its tracks already run low-to-high energy (then
+    # valence) for a gradual build, and the phase-independent cadence
+    # distances are thresholded (never recomputed) for both the normal
+    # and relaxed tolerances
+    order = np.lexsort((valence_q, energy_q))
+    sorted_energy = energy_q[order]
+    sorted_bpm_dist = bpm_distance(tempo_q, target_cadence)[order]
+    sorted_bpm_ok = sorted_bpm_dist <= 2 * bpm_tolerance
+    sorted_bpm_relaxed = None
+
     for phase in phases:
-        print(f"\nPhase: {phase['name']} ({phase['duration']:.1f} min, energy {phase['energy_min']}-{phase['energy_max']})")
+        logger.debug("Phase: %s (%.1f min, energy %s-%s)", phase['name'], phase['duration'], phase['energy_min'], phase['energy_max'])
+
+        # Locate the phase's energy window in the sorted order
+        lo = np.searchsorted(sorted_energy, quantize_feature(phase['energy_min']), side='left')
+        hi = np.searchsorted(sorted_energy, quantize_feature(phase['energy_max']), side='right')
 
         # Filter tracks for this phase
-        suitable_tracks = filter_tracks_for_phase(
-            tracks,
-            phase,
-            target_cadence,
-            bpm_tolerance
-        )
-
-        print(f"  Found {len(suitable_tracks)} suitable tracks")
-
-        # If not enough tracks, relax BPM constraint
-        if len(suitable_tracks) < 3:
-            print(f"  Not enough tracks, relaxing BPM tolerance to 10")
-            suitable_tracks = filter_tracks_for_phase(
-                tracks,
-                phase,
-                target_cadence,
-                bpm_tolerance=10
-            )
+        window = order[lo:hi]
+        suitable_idx = window[sorted_bpm_ok[lo:hi]]
+
+        logger.debug("  Found %d suitable tracks", len(suitable_idx))
+
+        # Relax only when the candidates cannot fill the phase's playtime;
+        # a handful of long tracks often covers a short phase, in which
+        # case the fallback scans are skipped entirely
+        target_duration_ms = phase['duration'] * 60 * 1000
+
+        # If not enough playtime, relax BPM constraint
+        if duration_arr[suitable_idx].sum() < target_duration_ms:
+            logger.debug("  Not enough playtime, relaxing BPM tolerance to 10")
+            if sorted_bpm_relaxed is None:
+                sorted_bpm_relaxed = sorted_bpm_dist <= 2 * 10
+            suitable_idx = window[sorted_bpm_relaxed[lo:hi]]
 
         # If still not enough, just use any tracks with matching energy
-        if len(suitable_tracks) < 3:
-            print(f"  Still not enough, using any tracks with matching energy")
-            suitable_tracks = [
-                t for t in tracks
-                if phase['energy_min'] <= t['energy'] <= phase['energy_max']
-            ]
+        if duration_arr[suitable_idx].sum() < target_duration_ms:
+            logger.debug("  Still not enough, using any tracks with matching energy")
+            suitable_idx = window
 
         # Fill this phase
-        phase_tracks = fill_phase_duration(suitable_tracks, phase['duration'])
-        print(f"  Selected {len(phase_tracks)} tracks")
+        phase_idx = fill_phase_duration(suitable_idx, duration_arr, phase['duration'])
+        logger.debug("  Selected %d tracks", len(phase_idx))
+
+        selected.append(phase_idx)
 
-        playlist.extend(phase_tracks)
+    playlist_idx = np.concatenate(selected) if selected else np.empty(0, dtype=np.int64)
 
-    print(f"\nTotal playlist: {len(playlist)} tracks, {sum(t['duration_ms'] for t in playlist) / 60000:.1f} minutes")
+    logger.debug("Total playlist: %d tracks, %.1f minutes", playlist_idx.size, duration_arr[playlist_idx].sum() / 60000)
 
-    return playlist
+    return playlist_idx
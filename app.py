@@ -3,7 +3,15 @@ Flask app for Marathon Music - Spotify playlist generator for runners.
 Handles OAuth, Spotify API calls, and playlist creation.
 """
 
+import logging
+import math
 import os
+from concurrent.futures import ThreadPoolExecutor
+from operator import itemgetter
+import diskcache
+import numpy as np
+import requests
+from requests.adapters import Retry
 from flask import Flask, render_template, request, redirect, session, url_for
 from dotenv import load_dotenv
 import spotipy
@@ -16,6 +24,8 @@ load_dotenv()
 app = Flask(__name__)
 app.secret_key = os.urandom(24)  # For session management
 
+logger = logging.getLogger(__name__)
+
 # Spotify API configuration
 SPOTIFY_CLIENT_ID = os.getenv('SPOTIFY_CLIENT_ID')
 SPOTIFY_CLIENT_SECRET = os.getenv('SPOTIFY_CLIENT_SECRET')
@@ -24,6 +34,123 @@ SPOTIFY_REDIRECT_URI = os.getenv('SPOTIFY_REDIRECT_URI')
 # Scopes needed: read user's saved tracks, create playlists, get audio features
 SCOPE = 'user-library-read playlist-modify-public playlist-modify-private'
 
+SPOTIFY_API_BASE = 'https://api.spotify.com/v1'
+
+# Concurrency limits for batched Spotify calls (stay under the rate limit)
+FEATURE_FETCH_WORKERS = 10
+PAGE_FETCH_WORKERS = 8
+
+# Audio features are immutable per track ID, so cache them across requests;
+# a returning user only pays API calls for newly-saved tracks
+audio_features_cache = diskcache.Cache('./af_cache')
+
+# Column extractor for the audio-features payload (avoids repeated
+# per-key dict indexing while assembling the feature columns)
+get_feature_columns = itemgetter('tempo', 'energy', 'valence')
+
+
+def make_spotify_session(access_token):
+    """
+    Create a pooled requests.Session for the hot Spotify endpoints.
+
+    Keep-alive connection pooling shares TCP and TLS setup across the
+    many paginated and batched calls a single /generate issues, and
+    skips spotipy's per-call request construction. Rate-limit and
+    transient server errors are retried with Retry-After backoff, like
+    spotipy does for its own calls - without this, one 429 from the
+    thread-pool fan-out would fail the whole request.
+    """
+    http = requests.Session()
+    http.headers['Authorization'] = f'Bearer {access_token}'
+    retries = Retry(
+        total=5,
+        backoff_factor=1,
+        status_forcelist=[429, 500, 502, 503, 504],
+        respect_retry_after_header=True
+    )
+    http.mount('https://', requests.adapters.HTTPAdapter(
+        pool_maxsize=max(FEATURE_FETCH_WORKERS, PAGE_FETCH_WORKERS),
+        max_retries=retries
+    ))
+    return http
+
+
+def iter_saved_track_stubs(http, limit=50):
+    """
+    Stream lightweight stubs of the user's saved tracks.
+
+    Pages are fetched in parallel (the first response reports the
+    library's total size, so the remaining offsets are known up front),
+    and each raw Spotify page - album art, full artist objects and other
+    fields we never look at - is dropped as soon as its stubs are
+    yielded. Peak memory stays at a page of raw JSON rather than the
+    whole library.
+    """
+    def get_page(offset):
+        response = http.get(
+            f'{SPOTIFY_API_BASE}/me/tracks',
+            params={'limit': limit, 'offset': offset}
+        )
+        response.raise_for_status()
+        return response.json()
+
+    def page_stubs(page):
+        for item in page['items']:
+            track = item['track']
+            if track['id']:
+                yield {
+                    'id': track['id'],
+                    'name': track['name'],
+                    'artist': track['artists'][0]['name'],
+                    'duration_ms': track['duration_ms']
+                }
+
+    first_page = get_page(0)
+    total = first_page['total']
+    offsets = [limit * n for n in range(1, math.ceil(total / limit))]
+
+    yield from page_stubs(first_page)
+
+    with ThreadPoolExecutor(max_workers=PAGE_FETCH_WORKERS) as pool:
+        for page in pool.map(get_page, offsets):
+            yield from page_stubs(page)
+
+
+def fetch_audio_features(http, track_ids):
+    """
+    Fetch audio features for all track IDs, using the persistent cache.
+
+    Only uncached IDs hit the Spotify API; those 100-track batches run
+    concurrently on a thread pool, the same pattern
+    iter_saved_track_stubs uses for pagination. New results are cached
+    for subsequent requests.
+    """
+    misses = [tid for tid in track_ids if tid not in audio_features_cache]
+    batches = [misses[i:i+100] for i in range(0, len(misses), 100)]
+
+    def get_batch(batch):
+        response = http.get(
+            f'{SPOTIFY_API_BASE}/audio-features',
+            params={'ids': ','.join(batch)}
+        )
+        response.raise_for_status()
+        return response.json()['audio_features']
+
+    if batches:
+        with ThreadPoolExecutor(max_workers=FEATURE_FETCH_WORKERS) as pool:
+            for batch_features in pool.map(get_batch, batches):
+                for features in batch_features:
+                    if features is not None:
+                        audio_features_cache[features['id']] = features
+
+    # Assemble in track order from the cache; IDs Spotify has no
+    # features for are simply skipped
+    return [
+        audio_features_cache[tid]
+        for tid in track_ids
+        if tid in audio_features_cache
+    ]
+
 
 def get_spotify_oauth():
     """Create a SpotifyOAuth object for handling authentication."""
@@ -101,65 +228,71 @@ def generate():
     distance = float(request.form.get('distance'))  # in kilometers
     goal_time = int(request.form.get('goal_time'))  # in minutes
 
-    # Create Spotify client
+    # Create Spotify client (playlist creation) and a pooled HTTP session
+    # for the hot read endpoints
     sp = spotipy.Spotify(auth=session['token_info']['access_token'])
+    http = make_spotify_session(session['token_info']['access_token'])
 
     try:
-        # Step 1: Fetch user's saved tracks
-        print("Fetching user's saved tracks...")
-        saved_tracks = []
-        results = sp.current_user_saved_tracks(limit=50)
-
-        while results:
-            saved_tracks.extend(results['items'])
-            if results['next']:
-                results = sp.next(results)
-            else:
-                break
-
-        print(f"Found {len(saved_tracks)} saved tracks")
-
-        # Step 2: Extract track IDs and get audio features
-        print("Fetching audio features...")
-        track_ids = [item['track']['id'] for item in saved_tracks if item['track']['id']]
-
-        # Spotify API limits: 100 tracks per request
-        all_features = []
-        for i in range(0, len(track_ids), 100):
-            batch = track_ids[i:i+100]
-            features = sp.audio_features(batch)
-            all_features.extend([f for f in features if f is not None])
-
-        # Combine track info with audio features
-        tracks_with_features = []
-        for item, features in zip(saved_tracks, all_features):
+        # Step 1: Stream user's saved tracks as lightweight stubs
+        logger.info("Fetching user's saved tracks...")
+        track_stubs = list(iter_saved_track_stubs(http))
+
+        logger.info("Found %d saved tracks", len(track_stubs))
+
+        # Step 2: Get audio features for the saved tracks
+        logger.info("Fetching audio features...")
+        track_ids = [stub['id'] for stub in track_stubs]
+
+        # Spotify API limits: 100 tracks per request; batches go out concurrently
+        all_features = fetch_audio_features(http, track_ids)
+
+        # Combine track stubs with audio features, building the feature
+        # columns (SoA) directly instead of a dict per track
+        features_by_id = {f['id']: f for f in all_features}
+        track_records = []
+        tempo_col = []
+        energy_col = []
+        valence_col = []
+        duration_col = []
+
+        for stub in track_stubs:
+            features = features_by_id.get(stub['id'])
             if features:
-                tracks_with_features.append({
-                    'id': item['track']['id'],
-                    'name': item['track']['name'],
-                    'artist': item['track']['artists'][0]['name'],
-                    'duration_ms': item['track']['duration_ms'],
-                    'tempo': features['tempo'],
-                    'energy': features['energy'],
-                    'valence': features['valence'],
-                    'danceability': features['danceability']
-                })
-
-        print(f"Got audio features for {len(tracks_with_features)} tracks")
+                track_records.append(stub)
+                tempo, energy, valence = get_feature_columns(features)
+                tempo_col.append(tempo)
+                energy_col.append(energy)
+                valence_col.append(valence)
+                duration_col.append(stub['duration_ms'])
+
+        logger.info("Got audio features for %d tracks", len(track_records))
+
+        # float32 halves the memory traffic of the downstream filters and
+        # is far more precise than the features themselves
+        tempo_arr = np.asarray(tempo_col, dtype=np.float32)
+        energy_arr = np.asarray(energy_col, dtype=np.float32)
+        valence_arr = np.asarray(valence_col, dtype=np.float32)
+        duration_arr = np.asarray(duration_col, dtype=np.int64)
 
         # Step 3: Generate playlist using algorithm
-        print("Generating playlist...")
-        playlist_tracks = generate_playlist(
-            tracks_with_features,
+        logger.info("Generating playlist...")
+        playlist_idx = generate_playlist(
             distance,
-            goal_time
+            goal_time,
+            tempo_arr,
+            energy_arr,
+            valence_arr,
+            duration_arr
         )
 
-        if not playlist_tracks:
+        if playlist_idx.size == 0:
             return "Not enough suitable tracks found! Try saving more songs to your Spotify library.", 400
 
+        playlist_tracks = [track_records[i] for i in playlist_idx]
+
         # Step 4: Create playlist in user's account
-        print("Creating Spotify playlist...")
+        logger.info("Creating Spotify playlist...")
         user_id = sp.current_user()['id']
 
         playlist_name = f"Marathon Music - {distance}km in {goal_time}min"
@@ -178,20 +311,23 @@ def generate():
             batch = track_uris[i:i+100]
             sp.playlist_add_items(playlist['id'], batch)
 
-        print(f"Playlist created: {playlist['external_urls']['spotify']}")
+        logger.info("Playlist created: %s", playlist['external_urls']['spotify'])
 
         return render_template(
             'success.html',
             playlist_url=playlist['external_urls']['spotify'],
             playlist_name=playlist_name,
             num_tracks=len(playlist_tracks),
-            duration_min=sum(t['duration_ms'] for t in playlist_tracks) // 60000
+            duration_min=int(duration_arr[playlist_idx].sum()) // 60000
         )
 
     except Exception as e:
-        print(f"Error: {e}")
+        logger.exception("Playlist generation failed")
         return f"An error occurred: {str(e)}", 500
 
+    finally:
+        http.close()
+
 
 if __name__ == '__main__':
     # Check that environment variables are set